@@ -123,13 +123,6 @@ if docker volume ls | grep -q "voice-chat-app_backend-data"; then
 else
     echo -e "${YELLOW}⚠ Not found${NC}"
 fi
-
-echo -n "Checking tts-audio volume... "
-if docker volume ls | grep -q "voice-chat-app_tts-audio"; then
-    echo -e "${GREEN}✓ Exists${NC}"
-else
-    echo -e "${YELLOW}⚠ Not found${NC}"
-fi
 echo ""
 
 echo "6. Network Connectivity"
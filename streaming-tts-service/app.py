@@ -4,32 +4,154 @@ Streaming TTS Service with Parler-TTS
 High-quality, low-latency text-to-speech with style control
 """
 
+import os
+
+# Configure the CUDA caching allocator before torch initialises CUDA
+os.environ.setdefault(
+    "PYTORCH_CUDA_ALLOC_CONF",
+    "expandable_segments:True,max_split_size_mb:512"
+)
+
 from flask import Flask, request, jsonify, Response, send_file
 from flask_cors import CORS
 import torch
-import torchaudio
 import numpy as np
+import soundfile as sf
 import io
-import os
-import uuid
-from datetime import datetime
+import hashlib
+import platform
+import shutil
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
 
 app = Flask(__name__)
 CORS(app)
 
-# Audio output directory
+# Audio output directory (expected to be a tmpfs mount)
 AUDIO_DIR = '/tmp/tts_audio'
 os.makedirs(AUDIO_DIR, exist_ok=True)
 
+def check_audio_dir():
+    """Report whether AUDIO_DIR is RAM-backed and how much space it has"""
+    try:
+        # Longest mount point containing AUDIO_DIR determines the filesystem
+        mount_point, fs_type = '', None
+        with open('/proc/mounts') as mounts:
+            for line in mounts:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                prefix = fields[1].rstrip('/') + '/'
+                if (AUDIO_DIR + '/').startswith(prefix) and len(fields[1]) >= len(mount_point):
+                    mount_point, fs_type = fields[1], fields[2]
+
+        usage = shutil.disk_usage(AUDIO_DIR)
+        free_mb = usage.free // (1024 * 1024)
+        if fs_type == 'tmpfs':
+            print(f"✅ Audio directory on tmpfs ({free_mb} MB free)")
+        else:
+            print(f"⚠️  Audio directory is not on tmpfs ({free_mb} MB free)")
+    except Exception as e:
+        print(f"⚠️  Could not inspect audio directory: {e}")
+
+check_audio_dir()
+
+# LRU cache of (text, style, language) -> generated audio, so repeats skip inference
+CACHE = OrderedDict()
+CACHE_MAX = 256
+CACHE_LOCK = threading.Lock()
+IN_FLIGHT = {}  # cache key -> Future of the response of the request generating it
+
 # Model loading flag
 MODEL_LOADED = False
 model = None
 tokenizer = None
 SAMPLING_RATE = 24000
 
+# Inference device and precision (bfloat16 only pays off on GPU)
+DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
+TORCH_DTYPE = torch.bfloat16 if DEVICE == "cuda" else torch.float32
+MAX_GENERATION_LENGTH = 2580  # Upper bound for the static KV cache
+GPU_MEMORY_FRACTION = 0.8
+
+# One inference already saturates the GPU; concurrent generate() calls only thrash it
+TTS_SEMAPHORE = threading.Semaphore(1)
+
+# All generate() calls (including compile warmup) run on this one long-lived thread:
+# torch.compile's CUDA graph state is thread-local, so graphs captured during
+# warmup are only reused by the thread that captured them
+INFERENCE_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix='tts-inference')
+
+# (created_at, filename) of audio files, oldest first, so cleanup only visits expired files
+CREATED_FILES = deque()
+MAX_FILE_AGE = 3600  # 1 hour
+CLEANUP_INTERVAL = 300  # 5 minutes
+
+# Audio that has been served as a cache repeat: filename -> wav bytes, or None
+# until /audio first reads it. Everything else is served from AUDIO_DIR.
+AUDIO_BYTES = {}
+
+# md5 of each WAV's bytes, used as its ETag whether served from memory or disk
+ETAGS = {}
+
+# Side stream for device-to-host copies; WAV files are written on a background thread
+COPY_STREAM = None
+SAVE_EXECUTOR = ThreadPoolExecutor(max_workers=1)
+PENDING_SAVES = {}
+SAVE_ERRORS = OrderedDict()  # filename -> error of a failed write, most recent last
+PENDING_LOCK = threading.Lock()
+
+# Decoder steps per streamed chunk; the streamer decodes overlapping windows between chunks
+STREAM_PLAY_STEPS = 50
+
+# Padded input lengths; each bucket is warmed up so compiled CUDA graphs are reused
+INPUT_LENGTH_BUCKETS = (64, 128, 192, 256)
+MODEL_COMPILED = False
+MODEL_QUANTIZED = False
+eager_forward = None  # Uncompiled forward, restored if the compiled one fails
+
+# Canonical voice styles served by /api/voices
+VOICES = [
+    {
+        'id': 'default',
+        'name': 'Default',
+        'description': 'A clear, friendly voice speaks naturally.'
+    },
+    {
+        'id': 'professional',
+        'name': 'Professional',
+        'description': 'A professional, clear voice speaks quickly and efficiently.'
+    },
+    {
+        'id': 'friendly',
+        'name': 'Friendly',
+        'description': 'A warm, friendly voice speaks enthusiastically.'
+    },
+    {
+        'id': 'calm',
+        'name': 'Calm',
+        'description': 'A calm, soothing voice speaks slowly and peacefully.'
+    },
+    {
+        'id': 'excited',
+        'name': 'Excited',
+        'description': 'An excited, energetic voice speaks quickly with enthusiasm.'
+    }
+]
+
+# Style description -> pre-tokenized tensors on DEVICE, filled in by load_model()
+STYLE_INPUTS = {}
+
 def load_model():
     """Load Parler-TTS model (or fallback to simple TTS)"""
-    global model, tokenizer, MODEL_LOADED
+    global model, tokenizer, MODEL_LOADED, MODEL_COMPILED, COPY_STREAM
+
+    if DEVICE == "cuda":
+        torch.cuda.set_per_process_memory_fraction(GPU_MEMORY_FRACTION)
+        COPY_STREAM = torch.cuda.Stream()
 
     try:
         print("Attempting to load Parler-TTS model...")
@@ -37,32 +159,525 @@ def load_model():
         from transformers import AutoTokenizer
 
         model_name = "parler-tts/parler-tts-mini-v1"
-        model = ParlerTTSForConditionalGeneration.from_pretrained(model_name)
+        model = ParlerTTSForConditionalGeneration.from_pretrained(
+            model_name,
+            attn_implementation="sdpa",
+            torch_dtype=TORCH_DTYPE
+        )
         tokenizer = AutoTokenizer.from_pretrained(model_name)
 
+        # Static KV cache avoids re-allocating the cache on every decoding step
+        model.generation_config.cache_implementation = "static"
+        model.generation_config.max_length = MAX_GENERATION_LENGTH
+
         # Move to GPU if available
-        device = "cuda" if torch.cuda.is_available() else "cpu"
-        model = model.to(device)
+        model = model.to(DEVICE)
 
         MODEL_LOADED = True
-        print(f"✅ Parler-TTS model loaded successfully on {device}")
+        print(f"✅ Parler-TTS model loaded successfully on {DEVICE} ({TORCH_DTYPE})")
+
+        if DEVICE == "cuda":
+            compile_model()
+        else:
+            quantize_model()
+
+        # After compiling, since padding depends on whether the model is compiled
+        build_style_inputs()
 
     except Exception as e:
         print(f"⚠️  Could not load Parler-TTS: {e}")
         print("⚠️  Falling back to simple TTS placeholder")
         MODEL_LOADED = False
 
-load_model()
+def build_style_inputs():
+    """Tokenize the canonical styles once; most requests use one of them"""
+    for voice in VOICES:
+        encoded = tokenize(voice['description'])
+        input_ids, attention_mask = to_device(encoded.input_ids, encoded.attention_mask)
+        STYLE_INPUTS[voice['description']] = {
+            'input_ids': input_ids,
+            'attention_mask': attention_mask
+        }
+
+def quantize_model():
+    """Dynamically quantize Linear layers to int8 for the CPU path"""
+    global MODEL_QUANTIZED
+
+    try:
+        # QNNPACK targets ARM (NEON); fbgemm is the optimized x86 engine
+        is_arm = platform.machine().lower() in ('arm64', 'aarch64')
+        engine = 'qnnpack' if is_arm else 'fbgemm'
+        if engine not in torch.backends.quantized.supported_engines:
+            engine = 'qnnpack'
+        torch.backends.quantized.engine = engine
+
+        # Keep the decoder output projections (lm_heads) in fp32; embeddings are not Linear
+        qconfig_spec = {
+            name: torch.quantization.default_dynamic_qconfig
+            for name, module in model.named_modules()
+            if isinstance(module, torch.nn.Linear) and 'lm_heads' not in name
+        }
+        torch.quantization.quantize_dynamic(
+            model,
+            qconfig_spec,
+            dtype=torch.qint8,
+            inplace=True
+        )
+
+        MODEL_QUANTIZED = True
+        print(f"✅ Parler-TTS quantized to int8 ({engine})")
+
+    except Exception as e:
+        print(f"⚠️  Could not quantize Parler-TTS: {e}")
+        print("⚠️  Keeping fp32 weights")
+        MODEL_QUANTIZED = False
+
+def compile_model():
+    """Compile the forward pass and capture CUDA graphs with a warmup run"""
+    global eager_forward, MODEL_COMPILED
+
+    eager_forward = model.forward
+    try:
+        print("Compiling Parler-TTS forward pass...")
+        model.forward = torch.compile(model.forward, mode="reduce-overhead")
+        MODEL_COMPILED = True
+
+        # "reduce-overhead" needs two passes per input shape: one to compile,
+        # one to record the graph. A short text padded to each bucket is enough.
+        for length in INPUT_LENGTH_BUCKETS:
+            warmup_kwargs = tokenize_inputs(
+                "A clear, friendly voice speaks naturally.",
+                "This is for compilation.",
+                prompt_length=length
+            )
+            for _ in range(2):
+                with inference_context():
+                    model.generate(**warmup_kwargs)
+
+        print("✅ Parler-TTS forward pass compiled")
+
+    except Exception as e:
+        print(f"⚠️  Could not compile Parler-TTS: {e}")
+        disable_compile()
+
+def disable_compile():
+    """Switch back to the eager forward pass for all later requests"""
+    global MODEL_COMPILED
+
+    if eager_forward is not None:
+        model.forward = eager_forward
+    MODEL_COMPILED = False
+    print("⚠️  Falling back to eager mode")
+
+    # Eager mode needs no padding; re-tokenize the canonical styles without it
+    if STYLE_INPUTS:
+        build_style_inputs()
+
+def is_compile_error(error):
+    """Whether error comes from dynamo/inductor/cudagraphs rather than the request"""
+    from torch._dynamo.exc import TorchDynamoException
+
+    # Compile-time inductor failures are wrapped in dynamo exceptions
+    if isinstance(error, TorchDynamoException):
+        return True
+    if isinstance(error, torch.cuda.OutOfMemoryError):
+        return False
+
+    # Cudagraph-tree replay/record errors are raised from inside torch/_inductor
+    innermost = error.__traceback__
+    while innermost is not None and innermost.tb_next is not None:
+        innermost = innermost.tb_next
+    if innermost is None:
+        return False
+    filename = innermost.tb_frame.f_code.co_filename.replace(os.sep, '/')
+    return '/torch/_inductor/' in filename or '/torch/_dynamo/' in filename
+
+def generate(allow_retry=True, **generate_kwargs):
+    """
+    model.generate() that falls back to eager if torch.compile itself fails
+
+    Must run on the inference thread. Other errors (OOM, bad input, a
+    streamer failure) are re-raised with the compiled forward left in
+    place. With allow_retry=False (streaming, where part of the audio
+    may already be sent) a compile error is re-raised after switching to
+    eager, so only later requests use the fallback.
+    """
+    try:
+        with inference_context():
+            return model.generate(**generate_kwargs)
+    except Exception as e:
+        if not MODEL_COMPILED or not is_compile_error(e):
+            raise
+        print(f"⚠️  Compiled Parler-TTS forward failed: {e}")
+        disable_compile()
+        if not allow_retry:
+            raise
+
+    with inference_context():
+        return model.generate(**generate_kwargs)
+
+def submit_inference(job):
+    """
+    Run job on the inference thread and return its future
+
+    TTS_SEMAPHORE is taken here and released when the job finishes, so
+    callers queue up in the request thread rather than in the executor.
+    """
+    TTS_SEMAPHORE.acquire()
+    try:
+        future = INFERENCE_EXECUTOR.submit(job)
+    except Exception:
+        TTS_SEMAPHORE.release()
+        raise
+    future.add_done_callback(lambda _: TTS_SEMAPHORE.release())
+    return future
+
+@contextmanager
+def inference_context():
+    """No-grad and mixed precision around generate()"""
+    with torch.no_grad(), torch.autocast(
+        device_type=DEVICE,
+        dtype=TORCH_DTYPE,
+        enabled=DEVICE == "cuda"
+    ):
+        yield
+
+def bucket_length(num_tokens):
+    """Smallest length bucket that fits num_tokens"""
+    for bucket in INPUT_LENGTH_BUCKETS:
+        if num_tokens <= bucket:
+            return bucket
+    # Past the largest bucket: round up to a multiple of the smallest (not warmed up)
+    step = INPUT_LENGTH_BUCKETS[0]
+    return -(-num_tokens // step) * step
+
+def tokenize(text, length=None, padding_side='right'):
+    """
+    Tokenize text into [1, n] host tensors
+
+    With a compiled model the sequence is padded to its length bucket
+    (or to length) so input shapes repeat; in eager mode it is left as is.
+    """
+    if not MODEL_COMPILED:
+        return tokenizer([text], return_tensors="pt")
+
+    encoded = tokenizer([text])
+    if length is None:
+        length = bucket_length(len(encoded['input_ids'][0]))
+    return tokenizer.pad(
+        encoded,
+        padding="max_length",
+        max_length=length,
+        padding_side=padding_side,
+        return_tensors="pt"
+    )
+
+def to_device(*tensors):
+    """Move [1, n] host tensors to DEVICE as one pinned, non-blocking copy"""
+    widths = [tensor.shape[-1] for tensor in tensors]
+    packed = torch.cat(tensors, dim=-1)
+    if DEVICE == "cuda":
+        packed = packed.pin_memory().to(DEVICE, non_blocking=True)
+    return packed.split(widths, dim=-1)
+
+def tokenize_inputs(style, text, prompt_length=None):
+    """
+    Tokenize style description and text into generate() kwargs
+
+    When compiled, each input is padded up to one of INPUT_LENGTH_BUCKETS
+    so there are only a few input shapes, all captured during warmup.
+    The prompt is padded on the left, as in Parler-TTS training: it sits
+    directly in front of the generated audio tokens, so right padding
+    would put pad tokens between the two. Canonical styles come
+    pre-tokenized from STYLE_INPUTS; everything else is moved to the
+    device together in one copy.
+    """
+    prompt = tokenize(text, prompt_length, padding_side='left')
+    description = STYLE_INPUTS.get(style)
+
+    if description is None:
+        encoded = tokenize(style)
+        input_ids, attention_mask, prompt_input_ids, prompt_attention_mask = to_device(
+            encoded.input_ids,
+            encoded.attention_mask,
+            prompt.input_ids,
+            prompt.attention_mask
+        )
+    else:
+        input_ids = description['input_ids']
+        attention_mask = description['attention_mask']
+        prompt_input_ids, prompt_attention_mask = to_device(
+            prompt.input_ids,
+            prompt.attention_mask
+        )
+
+    return {
+        'input_ids': input_ids,
+        'attention_mask': attention_mask,
+        'prompt_input_ids': prompt_input_ids,
+        'prompt_attention_mask': prompt_attention_mask
+    }
+
+def cache_key(text, style, language):
+    """Cache key for a synthesis request; also used as the audio file name"""
+    return hashlib.md5(f"{text}|{style}|{language}".encode()).hexdigest()
+
+def cache_get(key):
+    """Return cached response data for key if its audio file still exists"""
+    with CACHE_LOCK:
+        entry = CACHE.get(key)
+        if entry is None:
+            return None
+
+        audio_path = os.path.join(AUDIO_DIR, f"{key}.wav")
+        if is_save_pending(f"{key}.wav"):
+            CACHE.move_to_end(key)
+            return entry
+        if not os.path.exists(audio_path):
+            del CACHE[key]
+            AUDIO_BYTES.pop(f"{key}.wav", None)
+            ETAGS.pop(f"{key}.wav", None)
+            return None
+
+        CACHE.move_to_end(key)
+        # Requested again, so worth keeping in memory for /audio
+        AUDIO_BYTES.setdefault(f"{key}.wav", None)
+
+    # Refresh mtime so cleanup_old_files keeps recently used audio
+    os.utime(audio_path)
+    return entry
+
+def cache_put(key, entry):
+    """Store response data for key, evicting the least recently used entry"""
+    with CACHE_LOCK:
+        CACHE[key] = entry
+        CACHE.move_to_end(key)
+        while len(CACHE) > CACHE_MAX:
+            evicted_key, _ = CACHE.popitem(last=False)
+            AUDIO_BYTES.pop(f"{evicted_key}.wav", None)
+
+def copy_to_host(generation):
+    """
+    Start copying generated audio to host memory without blocking
+
+    Returns the float32 host tensor and a CUDA event that is recorded
+    once the copy has landed (None when running on CPU).
+    """
+    generation = generation.to(torch.float32)
+    if COPY_STREAM is None:
+        return generation.cpu(), None
+
+    host_audio = torch.empty(generation.shape, dtype=torch.float32, pin_memory=True)
+    COPY_STREAM.wait_stream(torch.cuda.current_stream())
+    with torch.cuda.stream(COPY_STREAM):
+        host_audio.copy_(generation, non_blocking=True)
+        generation.record_stream(COPY_STREAM)
+
+    ready_event = torch.cuda.Event()
+    ready_event.record(COPY_STREAM)
+    return host_audio, ready_event
+
+def write_wav(audio_path, audio_arr):
+    """
+    Write a mono float or int16 waveform to a 16-bit PCM WAV file
+
+    The file is written under a temporary name and renamed into place,
+    so readers never see a truncated or half-rewritten file. Returns the
+    md5 of the written bytes.
+    """
+    if audio_arr.dtype != np.int16:
+        audio_arr = np.clip(audio_arr * 32767, -32768, 32767).astype(np.int16)
+
+    wav_buffer = io.BytesIO()
+    sf.write(wav_buffer, audio_arr, SAMPLING_RATE, format='WAV', subtype='PCM_16')
+    wav_bytes = wav_buffer.getbuffer()
+
+    tmp_path = f"{audio_path}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(wav_bytes)
+        os.replace(tmp_path, audio_path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    return hashlib.md5(wav_bytes).hexdigest()
+
+def file_etag(audio_filename):
+    """ETag for a file in AUDIO_DIR, hashing it once if it predates this process"""
+    with CACHE_LOCK:
+        etag = ETAGS.get(audio_filename)
+    if etag is not None:
+        return etag
+
+    with open(os.path.join(AUDIO_DIR, audio_filename), 'rb') as f:
+        etag = hashlib.md5(f.read()).hexdigest()
+    with CACHE_LOCK:
+        return ETAGS.setdefault(audio_filename, etag)
+
+def pcm16_converter():
+    """
+    Build a float -> int16 PCM bytes converter with reusable buffers
+
+    Streamed chunks are all about the same size, so the scratch arrays
+    are allocated once per stream instead of twice per chunk.
+    """
+    buffers = {
+        'scaled': np.empty(0, dtype=np.float32),
+        'pcm': np.empty(0, dtype=np.int16)
+    }
+
+    def to_pcm16(audio):
+        num_samples = audio.shape[0]
+        if len(buffers['pcm']) < num_samples:
+            buffers['scaled'] = np.empty(num_samples, dtype=np.float32)
+            buffers['pcm'] = np.empty(num_samples, dtype=np.int16)
+
+        scaled = buffers['scaled'][:num_samples]
+        pcm = buffers['pcm'][:num_samples]
+        np.multiply(audio, 32767, out=scaled)
+        np.clip(scaled, -32768, 32767, out=scaled)
+        pcm[...] = scaled  # In-place cast, no new array
+        return pcm.tobytes()
+
+    return to_pcm16
+
+def fallback_tone(text):
+    """Placeholder 440 Hz tone as int16 PCM, roughly 0.5s per word"""
+    duration = len(text.split()) * 0.5  # Rough estimate
+    samples = int(duration * SAMPLING_RATE)
+    frequency = 440  # A4 note
+
+    # float32 phase and a single cast straight to int16 samples
+    n = np.arange(samples, dtype=np.float32)
+    n *= np.float32(2 * np.pi * frequency / SAMPLING_RATE)
+    np.sin(n, out=n)
+    n *= np.float32(0.3 * 32767)
+    return n.astype(np.int16)
+
+def schedule_save(audio_filename, audio, ready_event=None):
+    """Write audio into AUDIO_DIR on the background save thread"""
+    audio_path = os.path.join(AUDIO_DIR, audio_filename)
+
+    def save():
+        if ready_event is not None:
+            ready_event.synchronize()
+        audio_arr = audio.numpy().squeeze() if torch.is_tensor(audio) else audio
+        etag = write_wav(audio_path, audio_arr)
+        with CACHE_LOCK:
+            ETAGS[audio_filename] = etag
+        CREATED_FILES.append((time.time(), audio_filename))
+
+    def on_done(future):
+        error = future.exception()
+        with PENDING_LOCK:
+            # The same file may have been scheduled again; leave a newer save alone
+            if PENDING_SAVES.get(audio_filename) is future:
+                del PENDING_SAVES[audio_filename]
+            if error is not None:
+                # Remembered so /audio can report it instead of a plain 404
+                SAVE_ERRORS[audio_filename] = error
+                while len(SAVE_ERRORS) > CACHE_MAX:
+                    SAVE_ERRORS.popitem(last=False)
+
+        if error is not None:
+            print(f"Error saving {audio_filename}: {error}")
+            # Don't hand the URL out again from the cache
+            with CACHE_LOCK:
+                CACHE.pop(audio_filename[:-len('.wav')], None)
+
+    # Any in-memory copy or ETag belongs to the previous version of this file
+    with CACHE_LOCK:
+        AUDIO_BYTES.pop(audio_filename, None)
+        ETAGS.pop(audio_filename, None)
+
+    with PENDING_LOCK:
+        SAVE_ERRORS.pop(audio_filename, None)
+        future = SAVE_EXECUTOR.submit(save)
+        PENDING_SAVES[audio_filename] = future
+    future.add_done_callback(on_done)
+
+def is_save_pending(audio_filename):
+    """Whether audio_filename is still being written"""
+    with PENDING_LOCK:
+        return audio_filename in PENDING_SAVES
+
+def wait_for_save(audio_filename):
+    """Block until a pending write of audio_filename has finished; return its error, if any"""
+    with PENDING_LOCK:
+        future = PENDING_SAVES.get(audio_filename)
+        if future is None:
+            return SAVE_ERRORS.get(audio_filename)
+    return future.exception()  # Waits without raising
+
+# Load (and compile) on the inference thread so warmup graphs belong to it. This runs
+# in the background so the Gunicorn worker finishes booting and keeps heartbeating;
+# /health and the TTS endpoints answer 503 until it is done.
+MODEL_LOADING = INFERENCE_EXECUTOR.submit(load_model)
+
+def model_ready():
+    """Whether load_model() has finished (with the model or the fallback)"""
+    return MODEL_LOADING.done()
 
 @app.route('/health', methods=['GET'])
 def health():
-    """Health check endpoint"""
+    """Health check endpoint (503 while the model is still loading)"""
+    ready = model_ready()
     return jsonify({
-        'status': 'ok',
+        'status': 'ok' if ready else 'loading',
         'service': 'streaming-tts',
+        'ready': ready,
         'model_loaded': MODEL_LOADED,
+        'model_compiled': MODEL_COMPILED,
+        'model_quantized': MODEL_QUANTIZED,
         'sampling_rate': SAMPLING_RATE
-    })
+    }), 200 if ready else 503
+
+def synthesize(audio_id, text, style):
+    """Generate audio for text into AUDIO_DIR and return the /api/tts response data"""
+    # Filename derived from the cache key
+    audio_filename = f"{audio_id}.wav"
+
+    if MODEL_LOADED:
+        # Use Parler-TTS on the inference thread (file I/O below runs outside it)
+        def run_generation():
+            # Tokenize style description and text
+            generate_kwargs = tokenize_inputs(style, text)
+
+            # Generate audio
+            generation = generate(**generate_kwargs)
+
+            # Enqueue the host copy (numpy has no bfloat16, so it is cast to float32)
+            return copy_to_host(generation)
+
+        audio_tensor, ready_event = submit_inference(run_generation).result()
+
+        num_samples = audio_tensor.shape[-1]
+
+        # Save audio file in the background; /audio waits for it if needed
+        schedule_save(audio_filename, audio_tensor, ready_event)
+
+    else:
+        # Fallback: Create a simple tone (for testing)
+        audio_arr = fallback_tone(text)
+        num_samples = len(audio_arr)
+
+        # Save audio file
+        schedule_save(audio_filename, audio_arr)
+
+    # Calculate duration
+    duration_ms = int((num_samples / SAMPLING_RATE) * 1000)
+
+    # Return audio file URL
+    audio_url = f"/audio/{audio_filename}"
+
+    return {
+        'audio_file': audio_url,
+        'duration': duration_ms,
+        'sampling_rate': SAMPLING_RATE,
+        'model_used': 'parler-tts' if MODEL_LOADED else 'fallback'
+    }
 
 @app.route('/api/tts', methods=['POST'])
 def text_to_speech():
@@ -87,68 +702,40 @@ def text_to_speech():
         if not text:
             return jsonify({'error': 'No text provided'}), 400
 
-        # Generate unique filename
-        audio_id = str(uuid.uuid4())
-        audio_filename = f"{audio_id}.wav"
-        audio_path = os.path.join(AUDIO_DIR, audio_filename)
-
-        if MODEL_LOADED:
-            # Use Parler-TTS
-            device = "cuda" if torch.cuda.is_available() else "cpu"
-
-            # Tokenize style description
-            input_ids = tokenizer(style, return_tensors="pt").input_ids.to(device)
-
-            # Tokenize text
-            prompt_input_ids = tokenizer(text, return_tensors="pt").input_ids.to(device)
-
-            # Generate audio
-            with torch.no_grad():
-                generation = model.generate(
-                    input_ids=input_ids,
-                    prompt_input_ids=prompt_input_ids,
-                    attention_mask=torch.ones_like(input_ids)
-                )
-
-            # Convert to audio
-            audio_arr = generation.cpu().numpy().squeeze()
-
-            # Save audio file
-            torchaudio.save(
-                audio_path,
-                torch.from_numpy(audio_arr).unsqueeze(0),
-                SAMPLING_RATE
-            )
-
-        else:
-            # Fallback: Create a simple tone (for testing)
-            duration = len(text.split()) * 0.5  # Rough estimate
-            samples = int(duration * SAMPLING_RATE)
-
-            # Generate simple sine wave (placeholder)
-            frequency = 440  # A4 note
-            t = np.linspace(0, duration, samples, False)
-            audio_arr = np.sin(frequency * 2 * np.pi * t) * 0.3
-
-            # Save audio file
-            torchaudio.save(
-                audio_path,
-                torch.from_numpy(audio_arr).unsqueeze(0).float(),
-                SAMPLING_RATE
-            )
-
-        # Calculate duration
-        duration_ms = int((len(audio_arr) / SAMPLING_RATE) * 1000)
-
-        # Return audio file URL
-        audio_url = f"/audio/{audio_filename}"
-
-        return jsonify({
-            'audio_file': audio_url,
-            'duration': duration_ms,
-            'sampling_rate': SAMPLING_RATE,
-            'model_used': 'parler-tts' if MODEL_LOADED else 'fallback'
-        })
+        if not model_ready():
+            return jsonify({'error': 'TTS model is still loading'}), 503
+
+        # Serve repeated requests straight from the cache
+        audio_id = cache_key(text, style, language)
+        cached = cache_get(audio_id)
+        if cached is not None:
+            return jsonify(cached)
+
+        # Identical requests arriving while this one generates wait for its result
+        with CACHE_LOCK:
+            in_flight = IN_FLIGHT.get(audio_id)
+            is_owner = in_flight is None
+            if is_owner:
+                in_flight = IN_FLIGHT[audio_id] = Future()
+
+        if not is_owner:
+            return jsonify(in_flight.result())
+
+        try:
+            # A previous owner may have finished between the cache check and here
+            response_data = cache_get(audio_id)
+            if response_data is None:
+                response_data = synthesize(audio_id, text, style)
+                cache_put(audio_id, response_data)
+            in_flight.set_result(response_data)
+        except Exception as e:
+            in_flight.set_exception(e)
+            raise
+        finally:
+            with CACHE_LOCK:
+                IN_FLIGHT.pop(audio_id, None)
+
+        return jsonify(response_data)
 
     except Exception as e:
         print(f"Error in text_to_speech: {e}")
@@ -176,54 +763,61 @@ def text_to_speech_stream():
         if not text:
             return jsonify({'error': 'No text provided'}), 400
 
+        if not model_ready():
+            return jsonify({'error': 'TTS model is still loading'}), 503
+
         def generate_audio_stream():
             """Generator function for streaming audio"""
 
             if MODEL_LOADED:
-                device = "cuda" if torch.cuda.is_available() else "cpu"
-
-                # Tokenize
-                input_ids = tokenizer(style, return_tensors="pt").input_ids.to(device)
-                prompt_input_ids = tokenizer(text, return_tensors="pt").input_ids.to(device)
-
                 # Generate with streaming (if model supports it)
                 try:
-                    # Note: Parler-TTS may not support true streaming yet
-                    # This is a placeholder for when it does
-                    with torch.no_grad():
-                        generation = model.generate(
-                            input_ids=input_ids,
-                            prompt_input_ids=prompt_input_ids,
-                            attention_mask=torch.ones_like(input_ids)
-                        )
-
-                    audio_arr = generation.cpu().numpy().squeeze()
-
-                    # Chunk the audio for streaming
-                    chunk_size = 4096
-                    for i in range(0, len(audio_arr), chunk_size):
-                        chunk = audio_arr[i:i+chunk_size]
+                    from parler_tts import ParlerTTSStreamer
+
+                    streamer = ParlerTTSStreamer(
+                        model,
+                        device=DEVICE,
+                        play_steps=STREAM_PLAY_STEPS
+                    )
+
+                    def run_generation():
+                        """Run generate() on the inference thread, feeding the streamer"""
+                        try:
+                            # Tokenize
+                            generate_kwargs = tokenize_inputs(style, text)
+
+                            generate(allow_retry=False, streamer=streamer, **generate_kwargs)
+                        except Exception as e:
+                            print(f"Streaming generation error: {e}")
+                            # Unblock the consumer loop below
+                            streamer.on_finalized_audio(
+                                np.zeros(0, dtype=np.float32),
+                                stream_end=True
+                            )
+
+                    generation_future = submit_inference(run_generation)
+
+                    # Emit audio as soon as each chunk is decoded
+                    to_pcm16 = pcm16_converter()
+                    for new_audio in streamer:
+                        if new_audio.shape[0] == 0:
+                            break
                         # Convert to bytes
-                        chunk_bytes = (chunk * 32767).astype(np.int16).tobytes()
-                        yield chunk_bytes
+                        yield to_pcm16(new_audio)
+
+                    generation_future.result()
 
                 except Exception as e:
                     print(f"Streaming error: {e}")
                     yield b''
 
             else:
-                # Fallback streaming
-                duration = len(text.split()) * 0.5
-                samples = int(duration * SAMPLING_RATE)
-                frequency = 440
-                t = np.linspace(0, duration, samples, False)
-                audio_arr = np.sin(frequency * 2 * np.pi * t) * 0.3
-
-                chunk_size = 4096
-                for i in range(0, len(audio_arr), chunk_size):
-                    chunk = audio_arr[i:i+chunk_size]
-                    chunk_bytes = (chunk * 32767).astype(np.int16).tobytes()
-                    yield chunk_bytes
+                # Fallback streaming: already int16, so just slice the byte buffer
+                audio_bytes = fallback_tone(text).tobytes()
+
+                chunk_bytes = 4096 * 2  # 4096 int16 samples
+                for i in range(0, len(audio_bytes), chunk_bytes):
+                    yield audio_bytes[i:i+chunk_bytes]
 
         return Response(
             generate_audio_stream(),
@@ -245,78 +839,113 @@ def serve_audio(filename):
     """Serve generated audio files"""
     try:
         audio_path = os.path.join(AUDIO_DIR, filename)
-        if os.path.exists(audio_path):
-            return send_file(audio_path, mimetype='audio/wav')
-        else:
+        save_error = wait_for_save(filename)
+        if save_error is not None:
+            return jsonify({'error': f'Failed to save audio: {save_error}'}), 500
+
+        if not os.path.exists(audio_path):
             return jsonify({'error': 'Audio file not found'}), 404
+
+        # Same ETag for the in-memory and on-disk paths
+        etag = file_etag(filename)
+
+        # Audio served from the cache is kept in memory after its first read
+        with CACHE_LOCK:
+            is_repeat = filename in AUDIO_BYTES
+            wav_bytes = AUDIO_BYTES.get(filename)
+
+        if is_repeat and wav_bytes is None:
+            with open(audio_path, 'rb') as f:
+                wav_bytes = f.read()
+            with CACHE_LOCK:
+                if filename in AUDIO_BYTES:  # Not evicted in the meantime
+                    AUDIO_BYTES[filename] = wav_bytes
+
+        if wav_bytes is not None:
+            response = Response(wav_bytes, mimetype='audio/wav')
+            response.set_etag(etag)
+            return response.make_conditional(
+                request,
+                accept_ranges=True,
+                complete_length=len(wav_bytes)
+            )
+
+        return send_file(
+            audio_path,
+            mimetype='audio/wav',
+            conditional=True,
+            etag=etag
+        )
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 @app.route('/api/voices', methods=['GET'])
 def list_voices():
     """List available voice styles"""
-    voices = [
-        {
-            'id': 'default',
-            'name': 'Default',
-            'description': 'A clear, friendly voice speaks naturally.'
-        },
-        {
-            'id': 'professional',
-            'name': 'Professional',
-            'description': 'A professional, clear voice speaks quickly and efficiently.'
-        },
-        {
-            'id': 'friendly',
-            'name': 'Friendly',
-            'description': 'A warm, friendly voice speaks enthusiastically.'
-        },
-        {
-            'id': 'calm',
-            'name': 'Calm',
-            'description': 'A calm, soothing voice speaks slowly and peacefully.'
-        },
-        {
-            'id': 'excited',
-            'name': 'Excited',
-            'description': 'An excited, energetic voice speaks quickly with enthusiasm.'
-        }
-    ]
-
-    return jsonify({'voices': voices})
+    return jsonify({'voices': VOICES})
 
 # Clean up old audio files periodically
+def track_existing_files():
+    """Queue audio files left over from a previous run, oldest first"""
+    try:
+        entries = [
+            (entry.stat().st_mtime, entry.name)
+            for entry in os.scandir(AUDIO_DIR)
+            if entry.is_file()
+        ]
+        CREATED_FILES.extend(sorted(entries))
+    except Exception as e:
+        print(f"Could not scan audio directory: {e}")
+
 def cleanup_old_files():
-    """Remove audio files older than 1 hour"""
+    """Remove audio files older than MAX_FILE_AGE, visiting only expired entries"""
     try:
-        current_time = datetime.now().timestamp()
-        for filename in os.listdir(AUDIO_DIR):
+        current_time = time.time()
+        with CACHE_LOCK:
+            cached_files = {f"{key}.wav" for key in CACHE}
+
+        while CREATED_FILES and current_time - CREATED_FILES[0][0] > MAX_FILE_AGE:
+            _, filename = CREATED_FILES.popleft()
             filepath = os.path.join(AUDIO_DIR, filename)
-            if os.path.isfile(filepath):
-                file_age = current_time - os.path.getmtime(filepath)
-                if file_age > 3600:  # 1 hour
-                    os.remove(filepath)
-                    print(f"Cleaned up old file: {filename}")
+            try:
+                mtime = os.stat(filepath).st_mtime
+            except FileNotFoundError:
+                continue  # Already gone
+
+            # Still cached or recently served: check again once it has aged out
+            if filename in cached_files or current_time - mtime <= MAX_FILE_AGE:
+                CREATED_FILES.append((current_time, filename))
+                continue
+
+            os.remove(filepath)
+            with CACHE_LOCK:
+                AUDIO_BYTES.pop(filename, None)
+                ETAGS.pop(filename, None)
+            print(f"Cleaned up old file: {filename}")
     except Exception as e:
         print(f"Cleanup error: {e}")
 
+def schedule_cleanup():
+    """Run cleanup_old_files now and then every CLEANUP_INTERVAL seconds"""
+    cleanup_old_files()
+    timer = threading.Timer(CLEANUP_INTERVAL, schedule_cleanup)
+    timer.daemon = True
+    timer.start()
+
+# Started at import so it also runs in the Gunicorn worker, not only under app.run
+track_existing_files()
+schedule_cleanup()
+
 if __name__ == '__main__':
     print("\n" + "="*60)
     print("🔊 Streaming TTS Service Starting")
     print("="*60)
-    print(f"Model loaded: {MODEL_LOADED}")
+    print("Model: loading in background (see /health)")
     print(f"Sampling rate: {SAMPLING_RATE} Hz")
     print(f"Audio directory: {AUDIO_DIR}")
     print("="*60 + "\n")
 
-    # Schedule cleanup
-    from threading import Timer
-    def schedule_cleanup():
-        cleanup_old_files()
-        Timer(3600, schedule_cleanup).start()  # Run every hour
-
-    schedule_cleanup()
-
+    # Development server; the container runs under Gunicorn (see Dockerfile)
     app.run(
         host='0.0.0.0',
         port=5053,
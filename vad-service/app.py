@@ -10,26 +10,101 @@ import torch
 import torchaudio
 import numpy as np
 import io
+import math
 import os
-import tempfile
 
 app = Flask(__name__)
 CORS(app)
 
+# ONNX Runtime does the heavy lifting; keep PyTorch's own pool from competing with it
+ONNX_NUM_THREADS = os.cpu_count() or 1
+torch.set_num_threads(1)
+
+def configure_onnx_threads(vad_model, num_threads):
+    """Recreate the ONNX Runtime session with intra-op threads pinned"""
+    import onnxruntime
+
+    model_path = getattr(vad_model.session, '_model_path', None)
+    if model_path is None:
+        print("⚠️  Could not locate Silero ONNX model path, keeping default threads")
+        return
+
+    opts = onnxruntime.SessionOptions()
+    opts.inter_op_num_threads = 1
+    opts.intra_op_num_threads = num_threads
+    vad_model.session = onnxruntime.InferenceSession(
+        model_path,
+        providers=['CPUExecutionProvider'],
+        sess_options=opts
+    )
+
 # Load Silero VAD model
 print("Loading Silero VAD model...")
 model, utils = torch.hub.load(
     repo_or_dir='snakers4/silero-vad',
     model='silero_vad',
     force_reload=False,
-    onnx=False
+    onnx=True
 )
+configure_onnx_threads(model, ONNX_NUM_THREADS)
 
 (get_speech_timestamps, save_audio, read_audio, VADIterator, collect_chunks) = utils
 
 # VAD parameters
 SAMPLING_RATE = 16000
 THRESHOLD = 0.5  # Speech probability threshold
+WINDOW_SIZE_SAMPLES = 512  # Silero window at 16kHz
+
+def load_audio(audio_file):
+    """Decode an uploaded audio file to a mono SAMPLING_RATE waveform"""
+    wav, sr = torchaudio.load(io.BytesIO(audio_file.read()))
+    wav = wav.mean(dim=0)
+    if sr != SAMPLING_RATE:
+        wav = torchaudio.functional.resample(wav, sr, SAMPLING_RATE)
+    return wav
+
+class ProbabilityRecorder:
+    """
+    Proxy for the VAD model that records every window probability
+
+    get_speech_timestamps already runs Silero over each window; passing
+    this proxy lets detect_speech reuse those probabilities for the
+    confidence score instead of running the model a second time.
+    """
+
+    def __init__(self, vad_model):
+        self.model = vad_model
+        self.probs = []
+
+    def __call__(self, x, sr):
+        prob = self.model(x, sr)
+        self.probs.append(prob)  # Kept as a tensor; read back once in segment_confidence
+        return prob
+
+    def __getattr__(self, name):
+        return getattr(self.model, name)
+
+def segment_confidence(window_probs, speech_timestamps, num_samples):
+    """
+    Mean recorded window probability within each speech segment
+
+    Returns None if the recorded probabilities do not line up one per
+    WINDOW_SIZE_SAMPLES window, e.g. if a hub update changes how
+    get_speech_timestamps calls the model.
+    """
+    expected = math.ceil(num_samples / WINDOW_SIZE_SAMPLES)
+    if len(window_probs) != expected:
+        print(f"VAD recorded {len(window_probs)} window probabilities, expected {expected}; skipping confidence")
+        return None
+
+    probs = torch.cat([prob.reshape(-1) for prob in window_probs])
+    window_starts = torch.arange(len(probs)) * WINDOW_SIZE_SAMPLES
+
+    starts = torch.tensor([ts['start'] for ts in speech_timestamps]).unsqueeze(1)
+    ends = torch.tensor([ts['end'] for ts in speech_timestamps]).unsqueeze(1)
+    mask = ((window_starts >= starts) & (window_starts < ends)).to(probs.dtype)
+
+    return (probs * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1)
 
 @app.route('/health', methods=['GET'])
 def health():
@@ -60,60 +135,47 @@ def detect_speech():
 
         audio_file = request.files['file']
 
-        # Save to temporary file
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.wav') as tmp_file:
-            audio_file.save(tmp_file.name)
-            tmp_path = tmp_file.name
-
-        try:
-            # Read audio
-            wav = read_audio(tmp_path, sampling_rate=SAMPLING_RATE)
-
-            # Get speech timestamps
-            speech_timestamps = get_speech_timestamps(
-                wav,
-                model,
-                threshold=THRESHOLD,
-                sampling_rate=SAMPLING_RATE,
-                min_speech_duration_ms=250,
-                min_silence_duration_ms=100,
-                window_size_samples=512,
-                speech_pad_ms=30
-            )
-
-            # Calculate average confidence
-            has_speech = len(speech_timestamps) > 0
-
-            # Get speech probabilities for confidence score
-            speech_probs = []
-            if has_speech:
-                for segment in speech_timestamps:
-                    segment_audio = wav[segment['start']:segment['end']]
-                    speech_prob = model(segment_audio, SAMPLING_RATE).item()
-                    speech_probs.append(speech_prob)
-
-            avg_confidence = np.mean(speech_probs) if speech_probs else 0.0
-
-            # Convert timestamps to seconds
-            timestamps_seconds = [
-                {
-                    'start': ts['start'] / SAMPLING_RATE,
-                    'end': ts['end'] / SAMPLING_RATE
-                }
-                for ts in speech_timestamps
-            ]
-
-            return jsonify({
-                'has_speech': has_speech,
-                'timestamps': timestamps_seconds,
-                'confidence': float(avg_confidence),
-                'num_segments': len(speech_timestamps)
-            })
-
-        finally:
-            # Clean up temp file
-            if os.path.exists(tmp_path):
-                os.unlink(tmp_path)
+        # Decode the upload in memory (no temp file round-trip)
+        wav = load_audio(audio_file)
+
+        # Get speech timestamps
+        recorder = ProbabilityRecorder(model)
+        speech_timestamps = get_speech_timestamps(
+            wav,
+            recorder,
+            threshold=THRESHOLD,
+            sampling_rate=SAMPLING_RATE,
+            min_speech_duration_ms=250,
+            min_silence_duration_ms=100,
+            window_size_samples=WINDOW_SIZE_SAMPLES,
+            speech_pad_ms=30
+        )
+
+        # Calculate average confidence
+        has_speech = len(speech_timestamps) > 0
+
+        # Confidence from the window probabilities recorded above (no second pass),
+        # reduced in torch and read back once
+        avg_confidence = 0.0
+        if has_speech:
+            confidences = segment_confidence(recorder.probs, speech_timestamps, len(wav))
+            avg_confidence = None if confidences is None else float(confidences.mean().cpu().numpy())
+
+        # Convert timestamps to seconds
+        timestamps_seconds = [
+            {
+                'start': ts['start'] / SAMPLING_RATE,
+                'end': ts['end'] / SAMPLING_RATE
+            }
+            for ts in speech_timestamps
+        ]
+
+        return jsonify({
+            'has_speech': has_speech,
+            'timestamps': timestamps_seconds,
+            'confidence': avg_confidence,
+            'num_segments': len(speech_timestamps)
+        })
 
     except Exception as e:
         print(f"Error in detect_speech: {e}")
@@ -142,8 +204,9 @@ def detect_stream():
         else:
             audio_bytes = request.data
 
-        # Convert to tensor
-        audio_array = np.frombuffer(audio_bytes, dtype=np.int16).astype(np.float32) / 32768.0
+        # Convert to tensor: scale int16 straight to float32 (one allocation), zero-copy into torch
+        arr_i16 = np.frombuffer(audio_bytes, dtype=np.int16)
+        audio_array = np.multiply(arr_i16, 1.0 / 32768.0, dtype=np.float32)
         wav = torch.from_numpy(audio_array)
 
         # Get speech probability